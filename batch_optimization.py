@@ -3,180 +3,334 @@ import os
 import sys
 import json
 import gurobipy as gp
+import numpy as np
 import math
 import time
 import random
-import copy
+# Default Gurobi parameters for the batching MIP, callers can override them with params
+MIP_PARAMS = {
+    'Symmetry': 2, # Batches are interchangeable
+    'MIPGap': 0.01, # A difference of one aisle is noise for larger instances
+}
+
+# Minimum number of orders before greedy_batches uses the Numba scoring loop,
+# below it importing Numba and loading the compiled loop takes longer than the pure Python loop
+NUMBA_MIN_ORDERS = 3000
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+def _best_order(masks, alive, batch_mask):
+    # The first alive order adding the fewest aisles, masks are split in 64 bit words
+    best_order = -1
+    best_order_num = masks.shape[1] * 64 + 1
+    for i in range(masks.shape[0]):
+        if not alive[i]:
+            continue
+        num_new_aisles = 0
+        for w in range(masks.shape[1]):
+            # Population count of the aisles added by the order
+            v = masks[i,w] & ~batch_mask[w]
+            v = v - ((v >> np.uint64(1)) & _M1)
+            v = (v & _M2) + ((v >> np.uint64(2)) & _M2)
+            v = (v + (v >> np.uint64(4))) & _M4
+            num_new_aisles += (v * _H01) >> np.uint64(56)
+        if num_new_aisles < best_order_num:
+            best_order = i
+            best_order_num = num_new_aisles
+        if num_new_aisles == 0:
+            break
+    return best_order
+
+_best_order_jit = None # _best_order compiled by Numba, False if Numba is not installed
+
+def compiled_best_order():
+    # Numba is only imported when the compiled scoring loop is first needed
+    global _best_order_jit
+    if _best_order_jit is None:
+        try:
+            from numba import njit
+            _best_order_jit = njit(cache=True)(_best_order)
+        except ImportError: # The greedy heuristic falls back to pure Python
+            _best_order_jit = False
+    return _best_order_jit
 
 class Solver():
     def __init__(self, orderlist, max_batch_size):
         self.order_ids = list(orderlist.keys()) # The ids for each order
         self.order_aisles = {} # The aisles for each order
         for o in self.order_ids:
-            self.order_aisles[o] = set([p['aisle'] for p in orderlist[o]])
+            self.order_aisles[o] = frozenset([p['aisle'] for p in orderlist[o]])
+        self._num_aisles = {o: len(a) for o, a in self.order_aisles.items()} # The number of aisles for each order
         # List of all aisles used by orders
         self.aisles = list(set([a for o in self.order_aisles.values() for a in o ]))
-        self.aisles_orders = {} # The orders visiting each aisle
-        for a in self.aisles:
-            orders = []
-            for o in self.order_ids:
-                if a in self.order_aisles[o]:
-                    orders.append(o)
-            self.aisles_orders[a] = orders
+        self.order_idx = {o: j for j, o in enumerate(self.order_ids)} # The position of each order
+        aisle_idx = {a: i for i, a in enumerate(self.aisles)}
+        self.aisles_orders = {a: [] for a in self.aisles} # The orders visiting each aisle
+        # Incidence matrix of the aisles (rows) visited by each order (columns)
+        self.A = np.zeros((len(self.aisles), len(self.order_ids)), dtype=bool)
+        for j, o in enumerate(self.order_ids):
+            for a in self.order_aisles[o]:
+                self.aisles_orders[a].append(o)
+                self.A[aisle_idx[a],j] = True
+        # Bitmask of the aisles for each order (one bit per aisle)
+        self.order_mask = {o: sum(1 << aisle_idx[a] for a in self.order_aisles[o]) for o in self.order_ids}
         self.K = max_batch_size
         self.B = math.ceil(len(self.order_ids)/self.K)
-
-    def MIP(self, initial_solution = False):
-        model = gp.Model("Model")
+        self._env = None # Shared Gurobi environment, started when the first model is built
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Release the Gurobi environment (and its license)
+        if self._env is not None:
+            self._env.dispose()
+            self._env = None
+
+    def env(self):
+        if self._env is None:
+            self._env = gp.Env(empty=True)
+            self._env.setParam('OutputFlag', 0)
+            self._env.start()
+        return self._env
+
+    def MIP_model(self, initial_solution = False, time_limit = None, no_rel_time = None, params = None):
+        model = gp.Model("Model", env=self.env())
+        model.Params.OutputFlag = 1
+        if time_limit:
+            model.Params.TimeLimit = time_limit
+        if no_rel_time: # Time spent in the NoRel heuristic before the root relaxation
+            model.Params.NoRelHeurTime = no_rel_time
+        # Parameters given by the caller override the defaults
+        for param, value in {**MIP_PARAMS, **(params or {})}.items():
+            model.setParam(param, value)
 
         # If an order is part of batch
-        x = model.addVars(self.order_ids, range(self.B), obj=0, vtype=gp.GRB.BINARY, name="x")
+        x = model.addMVar((len(self.order_ids), self.B), vtype=gp.GRB.BINARY, name="x")
 
-        # If a batch visits aisle
-        y = model.addVars(range(self.B), self.aisles, obj=0, vtype=gp.GRB.BINARY, name="y")
+        # If a batch visits aisle (integral in optimal solutions since x is binary and y >= x is minimized)
+        y = model.addMVar((self.B, len(self.aisles)), lb=0, ub=1, vtype=gp.GRB.CONTINUOUS, name="y")
 
         if initial_solution:
-            single_batch_optimal = solver.greedy_optimal_single_batching()
-            # Use greedy solution as starting solution
-            for b, batch in enumerate(single_batch_optimal):
-                for o in self.order_ids:
-                    if o in batch:
-                        x[o,b].Start = 1
-                    else: 
-                        x[o,b].Start = 0
-
-            for b, batch in enumerate(single_batch_optimal):
-                for a in self.aisles:
-                    for o in self.aisles_orders[a]:
-                        if o in batch:
-                            y[b,a].Start = 1        
+            greedy_solution = self.greedy_batches()
+            # Use greedy solution as starting solution, Gurobi completes y and d from x
+            x_start = np.zeros((len(self.order_ids), self.B))
+            for b, batch in enumerate(greedy_solution):
+                x_start[[self.order_idx[o] for o in batch], b] = 1
+            x.Start = x_start
 
         # Number of aisles for each batch
-        d = model.addVars(range(self.B), obj=1, vtype=gp.GRB.INTEGER, name="d")
+        d = model.addMVar(self.B, lb=0, vtype=gp.GRB.CONTINUOUS, name="d")
 
         # Each batch cannot exceed the maximum size K
-        model.addConstrs((gp.quicksum(x[o,b] for o in self.order_ids) <= self.K for b in range(self.B)), name='batch_size')
+        model.addConstr(x.sum(axis=0) <= self.K, name='batch_size')
 
         # Each order must be in exactly one batch
-        model.addConstrs((gp.quicksum(x[o,b] for b in range(self.B)) == 1 for o in self.order_ids), name='single_batch')
+        model.addConstr(x.sum(axis=1) == 1, name='single_batch')
 
-        model.addConstrs((y[b,a] >= x[o,b] for b in range(self.B) for a in self.aisles for o in self.aisles_orders[a]), name='batch_aisle')
+        # A batch visits an aisle if any of its orders visits the aisle (one row per order visiting the aisle)
+        aisle_idx, order_idx = np.nonzero(self.A)
+        model.addConstr(x[order_idx,:] <= y[:,aisle_idx].T, name='batch_aisle')
 
         # Controlling the batch number of aisles variables
-        model.addConstrs((d[b] == gp.quicksum(y[b,a] for a in self.aisles) for b in range(self.B)), name='num_aisles')
+        model.addConstr(d == y.sum(axis=1), name='num_aisles')
+
+        model.setObjective(d.sum())
+
+        if os.environ.get("DUMP_LP"):
+            model.write("model.lp")
+
+        return model, x
 
-        model.setObjective(gp.quicksum(d[b] for b in range(self.B)))
+    def MIP(self, initial_solution = False, time_limit = None, no_rel_time = None, params = None):
+        model, x = self.MIP_model(initial_solution, time_limit, no_rel_time, params)
 
-        model.update()
+        model.optimize()
+
+        if model.SolCount == 0: # No solution found, e.g. within the time limit
+            return None
 
-        model.write("model.lp")
+        # Read all solution values at once
+        return self.read_batches(x.X)
+
+    def MIP_pool(self, pool_size, initial_solution = False, time_limit = None, no_rel_time = None, params = None):
+        # The distinct batchings among the pool_size best solutions, best first (can be fewer than pool_size, set a time_limit)
+        model, x = self.MIP_model(initial_solution, time_limit, no_rel_time, params)
+        # Search for the pool_size best batchings in a single solve
+        model.Params.PoolSearchMode = 2
+        model.Params.PoolSolutions = pool_size
 
         model.optimize()
 
+        pool = []
+        partitions = set()
+        for i in range(model.SolCount):
+            model.Params.SolutionNumber = i
+            batches = self.read_batches(x.Xn)
+            # The same partition of the orders with the batches in another order
+            partition = frozenset(frozenset(batch) for batch in batches)
+            if partition not in partitions:
+                partitions.add(partition)
+                pool.append(batches)
+        return pool
+
+    def read_batches(self, x_val):
+        # Batches from the values of the x variables
         batches = []
         for k in range(self.B):
             batch = []
-            for o in self.order_ids:
-                if x[o,k].X != 0:
+            for j, o in enumerate(self.order_ids):
+                if x_val[j,k] > 0.5:
                     batch.append(o)
             batches.append(batch)
 
         return batches
     
     def greedy_optimal_single_batching_with_seed(self):
+        sub_model = self.single_batch_model()
         batches = []
-        order_ids = copy.copy(self.order_ids)
-        order_ids.sort(reverse = True,key=self.num_aisles)
+        # Orders sorted on the number of aisles, the unbatched ones are kept in a set
+        ordered = sorted(self.order_ids, reverse = True, key=self._num_aisles.get)
+        remaining = set(self.order_ids)
         for b in range(self.B):
-            batch = self.MIP_single_batch(order_ids, min(14,len(order_ids)), order_ids[0])
+            seed = next(o for o in ordered if o in remaining) # Largest unbatched order
+            batch = self.MIP_single_batch(sub_model, min(self.K,len(remaining)), seed)
             batches.append(batch)
-            for o in batch:
-                order_ids.remove(o)
+            remaining.difference_update(batch)
         return batches
     
     def greedy_optimal_single_batching(self):
+        sub_model = self.single_batch_model()
         batches = []
-        order_ids = copy.copy(self.order_ids)
+        remaining = set(self.order_ids)
         for b in range(self.B):
-            batch = self.MIP_single_batch(order_ids, min(14,len(order_ids)))
+            batch = self.MIP_single_batch(sub_model, min(self.K,len(remaining)))
             batches.append(batch)
-            for o in batch:
-                order_ids.remove(o)
+            remaining.difference_update(batch)
         return batches
 
-    def MIP_single_batch(self, order_ids, batch_size, seed = None):
-        aisles = list(set([a for o in self.order_aisles if o in order_ids for a in self.order_aisles[o]]))
-        model = gp.Model("Model")
-        model.setParam('OutputFlag', 0)
+    def single_batch_model(self):
+        # The model is built once over all orders and reused for every batch of one heuristic run.
+        # MIP_single_batch permanently fixes batched orders and unreachable aisles to 0,
+        # so a new model is needed for every run.
+        model = gp.Model("SingleBatch", env=self.env())
         # If an order is part of the batch
-        x = model.addVars(order_ids, obj=0, vtype=gp.GRB.BINARY, name="x")
+        x = model.addMVar(len(self.order_ids), vtype=gp.GRB.BINARY, name="x")
 
-        # If aisle is visited
-        y = model.addVars(aisles, obj=1, vtype=gp.GRB.BINARY, name="y")     
+        # If aisle is visited (integral in optimal solutions since x is binary and y >= x is minimized)
+        y = model.addMVar(len(self.aisles), lb=0, ub=1, vtype=gp.GRB.CONTINUOUS, name="y")
 
-        if seed is not None: # Fix the seed as part of the order
-            model.addConstr(x[seed] == 1)
+        # Batch must be of size batch_size (set before each solve)
+        size = model.addConstr(x.sum() == 0, name='batch_size')
 
-        # Batch must be of size batch_size
-        model.addConstr((gp.quicksum(x[o] for o in order_ids) == batch_size), name='batch_size')
+        # An aisle is visited if any order in the batch visits it (one row per order visiting the aisle)
+        aisle_idx, order_idx = np.nonzero(self.A)
+        model.addConstr(x[order_idx] <= y[aisle_idx], name='batch_aisle')
 
-        model.addConstrs((y[a] >= x[o] for a in aisles for o in self.aisles_orders[a] if o in order_ids), name='batch_aisle')
+        model.setObjective(y.sum())
 
-        model.update()
+        # The number of unbatched orders visiting each aisle
+        aisle_num_orders = self.A.sum(axis=1)
 
-        model.write("model.lp")
+        return model, x, y, size, aisle_num_orders
 
-        model.setObjective(gp.quicksum(y[a] for a in aisles))
+    def MIP_single_batch(self, sub_model, batch_size, seed = None):
+        # sub_model is the tuple from single_batch_model, the selected batch is removed from it
+        model, x, y, size, aisle_num_orders = sub_model
+        size.RHS = batch_size
+
+        if seed is not None: # Fix the seed as part of the order
+            x[self.order_idx[seed]].LB = 1
+
+        if os.environ.get("DUMP_LP"):
+            model.write("model.lp")
 
         model.optimize()
+        # Batched orders are fixed to 0, so only unbatched orders can be selected
+        x_val = x.X # Read all solution values at once
         batch = []
-        for o in order_ids:
-            if x[o].X != 0:
+        for j, o in enumerate(self.order_ids):
+            if x_val[j] > 0.5:
                 batch.append(o)
+
+        # Batched orders cannot be part of later batches
+        batch_idx = [self.order_idx[o] for o in batch]
+        x[batch_idx].UB = 0
+        aisle_num_orders -= self.A[:,batch_idx].sum(axis=1)
+        # Aisles that cannot be reached by the remaining orders
+        y[np.flatnonzero(aisle_num_orders == 0)].UB = 0
+        if seed is not None:
+            x[self.order_idx[seed]].LB = 0
         return batch
 
     def random_batches(self):
-        order_ids = copy.copy(self.order_ids)
-        batches = []
-        for _ in range(self.B): 
-            batch = []
-            while len(batch) < min(self.K,len(batch) + len(order_ids)):
-                random_order = random.choice(order_ids)
-                batch.append(random_order)
-                order_ids.remove(random_order)
-            batches.append(batch)
-        return batches
+        # Random permutation of the orders split into batches of size K
+        order_ids = random.sample(self.order_ids, len(self.order_ids))
+        return [order_ids[b*self.K:(b+1)*self.K] for b in range(self.B)]
 
     def num_aisles(self, o):
-        return len(self.order_aisles[o])
+        return self._num_aisles[o]
 
     def greedy_batches(self):
-        order_ids = copy.copy(self.order_ids)
-        # Sort orders on the nmber of aisles
-        order_ids.sort(reverse = True,key=self.num_aisles)
+        # Sort orders on the nmber of aisles, the unbatched ones are kept in a set
+        ordered = sorted(self.order_ids, reverse = True, key=self._num_aisles.get)
+        if len(ordered) >= NUMBA_MIN_ORDERS and compiled_best_order():
+            return self.greedy_batches_numba(ordered)
+        remaining = set(self.order_ids)
+        order_mask = self.order_mask
 
         batches = []
         for _ in range(self.B): 
-            batch = []
-            batch_aisles = set(self.order_aisles[order_ids[0]])
-            batch.append(order_ids[0]) # Select largest order
-            batch.remove(order_ids[0])
-            while len(batch) < min(self.K,len(batch) + len(order_ids)):
+            seed = next(o for o in ordered if o in remaining) # Select largest order
+            batch = [seed]
+            batch_mask = order_mask[seed]
+            remaining.discard(seed)
+            while len(batch) < self.K and remaining:
                 best_order = None
-                best_order_aisles = set()
                 best_order_num = math.inf
                 # Find the largest order with fewest number of aisles added
-                for o in order_ids:
-                    num_new_aisles = len(self.order_aisles[o] - batch_aisles) # The number of aisles added
+                for o in ordered:
+                    if o not in remaining:
+                        continue
+                    num_new_aisles = (order_mask[o] & ~batch_mask).bit_count() # The number of aisles added
                     if num_new_aisles < best_order_num:
                         best_order = o
-                        best_order_aisles = self.order_aisles[o]
                         best_order_num = num_new_aisles
                     if num_new_aisles == 0: # Largest order (in aisles) with best aisles added
                         break
                 batch.append(best_order)
-                batch_aisles = batch_aisles.union(best_order_aisles)
-                order_ids.remove(best_order)
+                batch_mask |= order_mask[best_order]
+                remaining.discard(best_order)
+            batches.append(batch)
+        return batches
+
+    def greedy_batches_numba(self, ordered):
+        # Same heuristic as greedy_batches with the scoring loop compiled by Numba
+        best_order_jit = compiled_best_order()
+        num_words = max(1, math.ceil(len(self.aisles)/64))
+        masks = np.zeros((len(ordered), num_words), dtype=np.uint64)
+        for i, o in enumerate(ordered):
+            for w in range(num_words):
+                masks[i,w] = (self.order_mask[o] >> (64*w)) & 0xFFFFFFFFFFFFFFFF
+        alive = np.ones(len(ordered), dtype=np.bool_)
+
+        batches = []
+        for _ in range(self.B):
+            seed = int(np.argmax(alive)) # Select largest order
+            batch = [ordered[seed]]
+            batch_mask = masks[seed].copy()
+            alive[seed] = False
+            while len(batch) < self.K and alive.any():
+                best_order = best_order_jit(masks, alive, batch_mask)
+                batch.append(ordered[best_order])
+                batch_mask |= masks[best_order]
+                alive[best_order] = False
             batches.append(batch)
         return batches
 
@@ -191,82 +345,80 @@ class Solver():
         print(num_aisles)
         return sum(num_aisles)
 
+def aisle_label(hall, section):
+    # Split Hall 1 aisles into A and B sections
+    if int(hall) > 22 or int(hall) == 1:
+        # Aisles 48 and 52 are different names for the south and north side respectively of the same aisle
+        if hall == '52':
+            return '48'
+        return hall
+    elif 1 < int(hall) < 19:
+        last_a_section = 34
+    elif hall == '19':
+        if section%2 != 0:
+            last_a_section = 33
+        else:
+            last_a_section = 18
+    elif hall == '22':
+        last_a_section = 16
+    else:
+        last_a_section = 18
+    if section <= last_a_section:
+        return hall + 'a'
+    return hall + 'b'
+
+# Aisle label for each (hall, section) location in the warehouse
+_AISLE_MAP = {(str(h), s): aisle_label(str(h), s) for h in range(1, 60) for s in range(1, 100)}
+
 def tsv2json(input_file, max_orders):
-    file = open(input_file, 'r') 
     json_data = {}
-    header = file.readline().strip().split('\t') # Read header
-    i = 0
-    for line in file:
-        values = line.strip().split('\t')
-        location = values[-1].split('-')
-        # Split Hall 1 aisles into A and B sections
-        if int(location[0]) > 22 or int(location[0]) == 1:
-             # Aisles 48 and 52 are different names for the south and north side respectively of the same aisle
-            if location[0] == '52':
-                aisle = '48'
-            else:
-                aisle = location[0]
-        elif int(location[0]) < 19 and int(location[0]) > 1:
-            if int(location[1]) <= 34:
-                aisle = location[0] + 'a'
-            else:
-                aisle = location[0] + 'b'
-        elif location[0] == '19':
-            if int(location[1])%2 != 0:
-                if int(location[1]) <= 33:
-                    aisle = location[0] + 'a'
-                else:
-                    aisle = location[0] + 'b'
-            else:
-                if int(location[1]) <= 18:
-                    aisle = location[0] + 'a'
-                else:
-                    aisle = location[0] + 'b'
-        elif location[0] == '22':
-            if int(location[1]) <= 16:
-                aisle = location[0] + 'a'
+    with open(input_file, 'r') as file:
+        header = file.readline().strip().split('\t') # Read header
+        for line in file:
+            values = line.strip().split('\t')
+            location = values[-1].split('-')
+            # Look up the aisle label, locations outside the table are computed directly
+            key = (location[0], int(location[1]))
+            data_entry = {
+                header[2]: values[2],
+                header[3]: values[3],
+                'aisle': _AISLE_MAP.get(key) or aisle_label(*key),
+                'section': location[1],
+                'shelf': location[2]
+                }
+
+            # Check if the order number is already a key in the dictionary
+            entries = json_data.get(values[1])
+            if entries is not None:
+                # If yes, append the entry to the existing list
+                entries.append(data_entry)
             else:
-                aisle = location[0] + 'b'
-        else:
-            if int(location[1]) <= 18:
-                aisle = location[0] + 'a'
-            else:
-                aisle = location[0] + 'b'
-        data_entry = {
-            header[2]: values[2],
-            header[3]: values[3],
-            'aisle': aisle,
-            'section': location[1],
-            'shelf': location[2]
-            }
-
-        # Check if the order number is already a key in the dictionary
-        if values[1] in json_data:
-            # If yes, append the entry to the existing list
-            json_data[values[1]].append(data_entry)
-        else:
-            if len(json_data) > max_orders:
-                break
-            # If no, create a new list with the entry
-            json_data[values[1]] = [data_entry]
+                if len(json_data) > max_orders:
+                    break
+                # If no, create a new list with the entry
+                json_data[values[1]] = [data_entry]
     return json_data
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Batch optimization.')
     parser.add_argument(dest="filepath", type=str, help='filepath')
-    # Time limit and order number limit to be added
+    parser.add_argument('--time_limit', type=float, default=None, help='time limit in seconds for the MIP')
+    # Order number limit to be added
 
     args = parser.parse_args()
     orderlist = tsv2json(args.filepath, max_orders=95)
-    solver = Solver(orderlist, max_batch_size=14)
-    #batches_random = solver.random_batches()
-    #batches_greedy = solver.greedy_batches()
-    #single_batch_optimal = solver.greedy_optimal_single_batching()
-    #single_batch_optimal_seed = solver.greedy_optimal_single_batching_with_seed()
-    batches_MIP = solver.MIP(initial_solution=True)
+    with Solver(orderlist, max_batch_size=14) as solver:
+        #batches_random = solver.random_batches()
+        #batches_greedy = solver.greedy_batches()
+        #single_batch_optimal = solver.greedy_optimal_single_batching()
+        #single_batch_optimal_seed = solver.greedy_optimal_single_batching_with_seed()
+        batches_MIP = solver.MIP(initial_solution=True, time_limit=args.time_limit)
     #print(f"Random: {solver.check_num_aisles(batches_random)}")
     #print(f"Greedy: {solver.check_num_aisles(batches_greedy)}")
     #print(f"Single batch: {solver.check_num_aisles(single_batch_optimal)}")
     #print(f"Single batch (seed): {solver.check_num_aisles(single_batch_optimal_seed)}")
-    print(f"MIP: {solver.check_num_aisles(batches_MIP)}")
-    print(batches_MIP)
\ No newline at end of file
+    if batches_MIP is None:
+        print("MIP: no solution found")
+    else:
+        print(f"MIP: {solver.check_num_aisles(batches_MIP)}")
+        print(batches_MIP)
\ No newline at end of file